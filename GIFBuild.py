@@ -43,6 +43,36 @@ OutputPrefix = "MolecularCrystal";
 
 OverwriteExisting = False;
 
+# Renderer used to draw the captioned animation frames.
+# 'matplotlib' typesets the captions using mathtext; 'pil' composites the frames and (plain-text) captions directly with the Python Imaging Library (PIL), which is considerably faster.
+# 'imagemagick' captions the frames and merges them into the animated GIF in a single Imagemagick convert command for each mode, without rendering them in Python; with this option, GIFEncoder is not used.
+
+CaptionedFrameRenderer = 'matplotlib';
+
+# Program used to encode the animated GIFs.
+# 'imagemagick' saves the captioned frames to temporary files and merges them with the Imagemagick convert program.
+# 'pil' and 'wand' pass the rendered frames in memory to PIL or to Imagemagick through the Wand library, respectively, which avoids writing the intermediate files and reading them back, and (for 'wand') starting a convert process for every mode.
+
+GIFEncoder = 'imagemagick';
+
+# Resolution (DPI) of the captioned animation frames; the frames are 8.0 x 8.6 cm.
+# Reducing this (e.g. to 100) produces smaller animations, and roughly halves the time spent rendering and encoding the frames.
+
+CaptionedFrameDPI = 200;
+
+# Folder used to cache captioned frames between runs.
+# Frames are cached by the (path and modification time of the) input image, the caption, the frame colour, the renderer and the DPI, so re-running the script after e.g. changing a subset of the frames only renders the frames that have changed.
+# The cache is not used with CaptionedFrameRenderer = 'imagemagick'; if set to None, frames are not cached.
+# Note that the cached frames are stored uncompressed, so the cache can become large.
+
+CaptionedFrameCacheFolder = None;
+
+# Number of processes to use for generating the animations.
+# Modes are processed in parallel, and the processes are divided between the modes and the rendering of the captioned frames for each mode.
+# If set to None, one process is started for each CPU reported by os.cpu_count().
+
+NumProcesses = None;
+
 # If set, print out some timing information from the slower routines in the code.
 
 DebugMode = False;
@@ -52,24 +82,40 @@ DebugMode = False;
 # Imports
 # -------
 
+import collections;
+import functools;
+import hashlib;
+import itertools;
 import math;
+import mmap;
 import os;
 import re;
+import shutil;
+import subprocess;
+import tempfile;
 import time;
 
 import numpy as np;
 
 import matplotlib as mpl;
-import matplotlib.pyplot as plt;
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor;
 from multiprocessing import Pool;
+from operator import itemgetter;
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg;
+from matplotlib.colors import to_rgb;
+from matplotlib.figure import Figure;
+from matplotlib.font_manager import FontProperties, findfont;
 
-from matplotlib.gridspec import GridSpec;
-from matplotlib.image import imread;
+from PIL import Image, ImageDraw, ImageFont;
 
-from mpl_toolkits.axes_grid.anchored_artists import AnchoredText;
+# Wand is only required for GIFEncoder = 'wand'.
 
-from scipy.stats import mode;
+try:
+    from wand.image import Image as WandImage;
+except ImportError:
+    WandImage = None;
 
 
 # ---------
@@ -78,25 +124,94 @@ from scipy.stats import mode;
 
 _XYZCommentLineRegex = re.compile(r"mode =\s+(?P<mode_index>\d+), v =\s+(?P<mode_frequency_thz>-?\d+\.\d+) THz \(\s*(?P<mode_frequency_invcm>-?\d+\.\d+) cm\^-1\), q =\s+(?P<mode_amplitude>-?\d+\.\d+) amu\^1/2 A");
 
+# Regex for parsing the header of binary (P6) PPM files: the magic number, width, height and maximum colour value, separated by whitespace and/or comments, followed by a single whitespace character before the pixel data.
+
+_PPMHeaderRegex = re.compile(br"P6(?:\s|#[^\n]*\n)+(?P<width>\d+)(?:\s|#[^\n]*\n)+(?P<height>\d+)(?:\s|#[^\n]*\n)+(?P<max_value>\d+)\s");
+
+# Number of bytes to read when searching for the PPM header.
+
+_PPMHeaderMaxLength = 4096;
+
+# Number of animation frames to read ahead while rendering.
+
+_AnimationFramePrefetchDepth = 2;
+
+# Width (pixels) of the border sampled to infer the background colour of the animation frames.
+
+_BackgroundColourBorderWidth = 10;
+
 _CaptionedAnimationFrameCaptionHeight = 0.5 / 2.54;
 
 # This works well for square anumation frames with a 0.5 cm caption; although Matplotlib will automatically centre and scale the frames, this may need to be adjusted for frames with significantly different aspect ratios.
 
 _CaptionedAnimationFrameDimensions = (8.0 / 2.54, 8.6 / 2.54);
 
+# Delay between animation frames (1/100 s).
+
+_AnimationFrameDelay = 10;
+
+# In-memory folder for temporary files.
+# On Linux, /dev/shm is a memory-backed (tmpfs) file system, so temporary frames written there never touch the disk; if it is not available, or does not have enough free space, the system default is used.
+
+_InMemoryTemporaryFolder = r"/dev/shm";
+
+# Supported GIF encoders.
+
+_GIFEncoders = ['imagemagick', 'pil', 'wand'];
+
+# Caption font size (pt).
+
+_CaptionFontSize = 8;
+
+# Caption format strings for the Matplotlib (mathtext) and PIL (plain text) renderers.
+# The captions are split into a prefix, with fields for the mode index and frequency (inverse cm), and a fixed suffix, which go either side of the normal-mode amplitude.
+
+_CaptionFormatStrings = {
+    'matplotlib' : (r"Mode {0}: $\nu$ = {1} cm$^{{-1}}$, $Q$ = ", r" amu$^{\frac{1}{2}}$ $\mathrm{\AA}$"),
+    'pil' : ("Mode {0}: \u03bd = {1} cm\u207b\u00b9, Q = ", " amu\u00bd \u00c5"),
+    'imagemagick' : ("Mode {0}: \u03bd = {1} cm\u207b\u00b9, Q = ", " amu\u00bd \u00c5")
+    };
+
 
 # ---------
 # Functions
 # ---------
 
+# Function to set up the Matplotlib fonts used for the captions.
+# This is called in the main process and used as the initialiser for the worker processes, so that the same settings are used if the workers are not forked from the main process (e.g. on Windows).
+
+def _InitialiseMatplotlib():
+    mpl.rc('font', **{ 'family' : 'serif', 'size' : _CaptionFontSize, 'serif' : 'Courier New' });
+    mpl.rc('mathtext', **{ 'fontset' : 'custom', 'rm' : 'Courier New', 'it' : 'Courier New:it', 'bf' : 'Courier New:bold' });
+
 # Function to read a merged animation XYZ file produced by MolecularCrystalPhononAnimation.py and extract the mode index, frequency (THz/inverse cm) and normal-mode coordinate (amplitude) associated with each frame.
 
+# The XYZ format consists of blocks of an atom count line, a comment line and one line per atom, so we read the atom count and comment lines and skip over the atom lines without processing them.
+
 def _ReadMergedXYZFileCommentLines(filePath):
     xyzData = { };
 
     with open(filePath, 'r') as inputReader:
         for line in inputReader:
-            match = _XYZCommentLineRegex.search(line);
+            line = line.strip();
+
+            # Skip any blank lines (e.g. at the end of the file).
+
+            if line == "":
+                continue;
+
+            try:
+                numAtoms = int(line);
+            except ValueError:
+                raise Exception("Error: Unexpected line \"{0}\" in input file \"{1}\" - expected an atom count.".format(line, filePath));
+
+            commentLine = next(inputReader, "");
+
+            # Skip the atom lines; islice() with start = stop = numAtoms consumes the lines without returning them.
+
+            next(itertools.islice(inputReader, numAtoms, numAtoms), None);
+
+            match = _XYZCommentLineRegex.search(commentLine);
 
             if match:
                 modeIndex = int(match.group('mode_index'));
@@ -115,34 +230,159 @@ def _ReadMergedXYZFileCommentLines(filePath):
     if len(xyzData) == 0:
         raise Exception("Error: No data extracted from input file \"{0}\".".format(filePath));
 
+    # Convert the lists of amplitudes to NumPy arrays.
+
+    for modeIndex, (modeFrequencyTHz, modeFrequencyInvCm, modeAmplitudes) in xyzData.items():
+        xyzData[modeIndex] = (
+            modeFrequencyTHz, modeFrequencyInvCm, np.fromiter(modeAmplitudes, dtype = np.float64, count = len(modeAmplitudes))
+            );
+
     return xyzData;
 
+# Function to parse the header of a binary (P6) PPM file from an open file.
+# Returns a tuple of (offset, shape) with the position of the pixel data in the file and the shape of the image array, or None if the file is not an 8-bit binary PPM file.
+
+def _ReadPPMHeader(inputReader):
+    inputReader.seek(0);
+
+    match = _PPMHeaderRegex.match(
+        inputReader.read(_PPMHeaderMaxLength)
+        );
+
+    if not match or int(match.group('max_value')) > 255:
+        return None;
+
+    return (match.end(), (int(match.group('height')), int(match.group('width')), 3));
+
+# Function to read the pixel data from a binary (P6) PPM file into a 'uint8' RGB array.
+# Since the frames in an animation all have the same dimensions, the header parsed from the first frame (ppmHeader) can be passed in to avoid parsing it again; it is only reparsed if the file size does not match.
+# The file is memory mapped and the array is a read-only view of the pixel data, so no copy is made; the kernel is asked to read the file ahead so that the data is (usually) in memory by the time it is used.
+# Returns None if the file is not an 8-bit binary PPM file.
+
+def _ReadPPMFile(filePath, ppmHeader = None):
+    with open(filePath, 'rb') as inputReader:
+        fileSize = os.fstat(inputReader.fileno()).st_size;
+
+        if ppmHeader != None:
+            offset, (height, width, depth) = ppmHeader;
+
+            if fileSize != offset + height * width * depth:
+                ppmHeader = None;
+
+        if ppmHeader == None:
+            ppmHeader = _ReadPPMHeader(inputReader);
+
+            if ppmHeader == None:
+                return None;
+
+        offset, shape = ppmHeader;
+
+        numBytes = shape[0] * shape[1] * shape[2];
+
+        if fileSize < offset + numBytes:
+            raise Exception("Error: _ReadPPMFile(): Unexpected end of file while reading \"{0}\".".format(filePath));
+
+        # The mapping remains valid after the file is closed, and is released when the array is no longer referenced.
+
+        buffer = mmap.mmap(inputReader.fileno(), 0, access = mmap.ACCESS_READ);
+
+    if hasattr(mmap, 'MADV_WILLNEED'):
+        buffer.madvise(mmap.MADV_WILLNEED);
+
+    return np.frombuffer(buffer, dtype = np.uint8, count = numBytes, offset = offset).reshape(shape);
+
+# Function to write a 'uint8' RGB image to a binary (P6) PPM file.
+# This is used for the temporary captioned frames, since PPM files are uncompressed and can be written with very little overhead.
+
+def _WritePPMFile(filePath, image):
+    height, width, depth = image.shape;
+
+    with open(filePath, 'wb') as outputWriter:
+        outputWriter.write(
+            "P6\n{0} {1}\n255\n".format(width, height).encode('ascii')
+            );
+
+        outputWriter.write(
+            np.ascontiguousarray(image, dtype = np.uint8).data
+            );
+
 # Function for reading animation frames.
-# This is a wrapper around imread() which changes the data type if need be.
+# The images are returned as 'uint8' RGB arrays (8 bpp, pixel colours in the range [0, 255]), which Matplotlib can display directly; converting to 'float32' would quadruple the memory used by each frame for no benefit.
+# Binary PPM files, which are written by e.g. VMD, are read with _ReadPPMFile() (optionally reusing ppmHeader), and other formats are read with PIL.
 
-def _ReadAnimationFrame(filePath):
-    # Read the image with imread().
+def _ReadAnimationFrame(filePath, ppmHeader = None):
+    if ppmHeader != None or os.path.splitext(filePath)[1].lower() == ".ppm":
+        image = _ReadPPMFile(filePath, ppmHeader);
 
-    image = imread(filePath);
+        if image is not None:
+            return image;
 
-    # The data type of the array returned by imread() depends on the image format.
-    # For Matplotlib, we need them in the 'float32' format (pixel colours in the range [0, 1]).
+    with Image.open(filePath) as image:
+        return np.asarray(image.convert('RGB'));
 
-    if image.dtype != np.float32:
-        # If the images are not read in this format, the most likely alternative is 'uint8' (8 bpp, pixel colours in the range [0, 255]).
+# Generator function to read a sequence of animation frames.
+# The next few frames are read in background threads while the caller processes the current one, so that reading the files overlaps with rendering.
 
-        if image.dtype == np.uint8:
-            image = image.astype(dtype = np.float32) / 255.0;
-        else:
-            raise Exception("Error: _RenderCaptionedAnimationFrame(): Unknown image data type '{0}'.".format(image.dtype));
+def _ReadAnimationFramesPrefetch(imageFiles, ppmHeader = None):
+    with ThreadPoolExecutor(max_workers = _AnimationFramePrefetchDepth) as executor:
+        imageFileIterator = iter(imageFiles);
 
-    return image;
+        futures = collections.deque(
+            executor.submit(_ReadAnimationFrame, imageFile, ppmHeader) for imageFile in itertools.islice(imageFileIterator, _AnimationFramePrefetchDepth)
+            );
 
-# Function to prepare captioned animation frames for a given mode using animation data prepared by the script.
+        while len(futures) > 0:
+            image = futures.popleft().result();
 
-def _PrepareCaptionedAnimationFrames(modeIndex, animationData, frameColour, fileNamePrefix):
-    modeFrequencyTHz, modeFrequencyInvCm, modeAmplitudes, animationFrameImageFiles = animationData;
+            # Queue the next frame before returning this one.
+
+            for imageFile in itertools.islice(imageFileIterator, 1):
+                futures.append(
+                    executor.submit(_ReadAnimationFrame, imageFile, ppmHeader)
+                    );
+
+            yield image;
+
+# Function to find the most common (modal) pixel colour in a 'uint8' RGB image (or an N x 3 array of pixels).
+# The RGB components of each pixel are packed into a 24-bit integer, so that the mode can be found in a single pass with np.bincount().
+# The colour is returned scaled to the range [0, 1] for use as a Matplotlib colour.
+
+def _GetModalPixelColour(image):
+    pixels = image.reshape((-1, 3)).astype(np.uint32);
 
+    pixelKeys = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2];
+
+    modeKey = int(np.bincount(pixelKeys).argmax());
+
+    return np.array([(modeKey >> 16) & 0xFF, (modeKey >> 8) & 0xFF, modeKey & 0xFF], dtype = np.float64) / 255.0;
+
+# Functions to locate a captioned frame in the cache and to add a captioned frame to the cache.
+# Frames are written to a temporary file and then renamed so that an interrupted run cannot leave incomplete frames in the cache.
+
+def _GetCachedCaptionedFrameFile(imageFile, caption, frameColour):
+    imageFileStat = os.stat(imageFile);
+
+    key = "|".join(
+        str(item) for item in (os.path.abspath(imageFile), imageFileStat.st_mtime_ns, imageFileStat.st_size, caption, frameColour, CaptionedFrameRenderer, CaptionedFrameDPI)
+        );
+
+    return os.path.join(
+        CaptionedFrameCacheFolder, "{0}.ppm".format(hashlib.blake2b(key.encode('utf-8'), digest_size = 16).hexdigest())
+        );
+
+def _AddCachedCaptionedFrame(cacheFile, fileName = None, image = None):
+    temporaryFile = "{0}.{1}.tmp".format(cacheFile, os.getpid());
+
+    if fileName != None:
+        shutil.copyfile(fileName, temporaryFile);
+    else:
+        _WritePPMFile(temporaryFile, image);
+
+    os.replace(temporaryFile, cacheFile);
+
+# Function to generate the captions for the animation frames for a given mode in the format required by CaptionedFrameRenderer.
+
+def _GenerateCaptions(modeIndex, modeFrequencyInvCm, modeAmplitudes):
     # Convert the mode frequency to a string with a sensible number of significant figures.
 
     modeFrequencyString = None;
@@ -165,14 +405,12 @@ def _PrepareCaptionedAnimationFrames(modeIndex, animationData, frameColour, file
 
     # Generate a format string for the mode amplitudes.
 
-    maxAmplitude = max(
-        abs(modeAmplitude) for modeAmplitude in modeAmplitudes
-        );
+    maxAmplitude = np.abs(modeAmplitudes).max();
 
     # Sanity check.
 
     if maxAmplitude == 0.0:
-        raise Exception("Error: _PrepareCaptionedAnimationFrames(): Maximum absolute normal-mode amplitude is zero.");
+        raise Exception("Error: _GenerateCaptions(): Maximum absolute normal-mode amplitude is zero.");
 
     power = int(
         math.floor(math.log10(math.fabs(maxAmplitude)))
@@ -186,123 +424,471 @@ def _PrepareCaptionedAnimationFrames(modeIndex, animationData, frameColour, file
 
     modeAmplitudeFormatString = "{{0: >{0}.3f}}".format(power + 6);
 
+    # The caption text other than the amplitude is the same for every frame, so we build it once.
+    # The amplitude format string is fixed width, so the captions for all the frames are the same length.
+
+    captionPrefixFormatString, captionSuffix = _CaptionFormatStrings[CaptionedFrameRenderer];
+
+    captionPrefix = captionPrefixFormatString.format(modeIndex, modeFrequencyString);
+
+    return [captionPrefix + modeAmplitudeFormatString.format(modeAmplitude) + captionSuffix for modeAmplitude in modeAmplitudes];
+
+# Function to prepare captioned animation frames for a given mode using animation data prepared by the script.
+# If fileNamePrefix is set, the frames are saved to files and a list of file names is returned; if not, the rendered frames are returned as a list of 'uint8' RGB arrays.
+
+def _PrepareCaptionedAnimationFrames(modeIndex, animationData, frameColour, fileNamePrefix, numProcesses = None):
+    modeFrequencyTHz, modeFrequencyInvCm, modeAmplitudes, animationFrameImageFiles = animationData;
+
     # Prepare the animation frames.
 
-    # Record the names of the output frames for further processing.
+    # Record the names of the output frames (if required) for further processing.
     # Also record the time taken for debugging purposes.
 
     startTime = time.time();
 
-    fileNames = [];
-
-    for i, (modeAmplitude, animationFrameImageFile) in enumerate(zip(modeAmplitudes, animationFrameImageFiles)):
-        # Generate a caption.
+    fileNames, frames = [], [];
 
-        caption = r"Mode {0}: $\nu$ = {1} cm$^{{-1}}$, $Q$ = {2} amu$^{{\frac{{1}}{{2}}}}$ $\mathrm{{\AA}}$".format(modeIndex, modeFrequencyString, modeAmplitudeFormatString.format(modeAmplitude));
+    captions = _GenerateCaptions(modeIndex, modeFrequencyInvCm, modeAmplitudes);
 
+    for i, (caption, animationFrameImageFile) in enumerate(zip(captions, animationFrameImageFiles)):
         # Generate a file name.
 
-        fileName = r"{0}_{1}-{2}.png".format(fileNamePrefix, modeIndex, i + 1);
+        fileName = None;
 
-        # Render and save the frame.
+        if fileNamePrefix != None:
+            fileName = r"{0}_{1}-{2}.ppm".format(fileNamePrefix, modeIndex, i + 1);
 
-        _RenderCaptionedAnimationFrame(animationFrameImageFile, caption, frameColour, fileName);
+            fileNames.append(fileName);
 
-        # Record the file name of the rendered frame.
+        # Record the image file, caption and file name of the rendered frame.
 
-        fileNames.append(fileName);
+        frames.append(
+            (animationFrameImageFile, caption, fileName)
+            );
+
+    # If CaptionedFrameCacheFolder is set, look up the frames in the cache and only render frames that are not found.
+
+    cacheFiles = [None] * len(frames);
+
+    if CaptionedFrameCacheFolder != None:
+        os.makedirs(CaptionedFrameCacheFolder, exist_ok = True);
+
+        cacheFiles = [
+            _GetCachedCaptionedFrameFile(imageFile, caption, frameColour) for imageFile, caption, _ in frames
+            ];
+
+    renderIndices = [i for i, cacheFile in enumerate(cacheFiles) if cacheFile == None or not os.path.isfile(cacheFile)];
+
+    renderFrames = [frames[i] for i in renderIndices];
+
+    # If the frames are binary PPM files, read the header from the first frame so that it does not need to be reparsed for each frame.
+
+    ppmHeader = None;
+
+    if len(renderFrames) > 0 and os.path.splitext(renderFrames[0][0])[1].lower() == ".ppm":
+        with open(renderFrames[0][0], 'rb') as inputReader:
+            ppmHeader = _ReadPPMHeader(inputReader);
+
+    # Select the render function.
+
+    renderFunction = _RenderCaptionedAnimationFramesPIL if CaptionedFrameRenderer == 'pil' else _RenderCaptionedAnimationFrames;
+
+    # The frames are independent of each other, so we render and save them in parallel using a process pool.
+    # The frames are split into one contiguous batch per process, so that each worker only needs to set up the figure (or template) once.
+
+    if numProcesses == None:
+        numProcesses = NumProcesses if NumProcesses != None else os.cpu_count();
+
+    if numProcesses > 1 and len(renderFrames) > 1:
+        batchSize = int(math.ceil(float(len(renderFrames)) / numProcesses));
+
+        batches = [renderFrames[i:i + batchSize] for i in range(0, len(renderFrames), batchSize)];
+
+        with Pool(processes = len(batches), initializer = _InitialiseMatplotlib) as pool:
+            batchImages = pool.starmap(renderFunction, [(batch, frameColour, ppmHeader) for batch in batches]);
+
+        # starmap() returns the results in order, so the rendered frames can simply be concatenated.
+
+        renderedImages = [image for batch in batchImages for image in batch];
+    else:
+        # If only one process is available, render the frames in this process and avoid the overhead of starting a pool.
+
+        renderedImages = renderFunction(renderFrames, frameColour, ppmHeader);
+
+    # Add the rendered frames to the cache, and fetch the remaining frames from it.
+
+    images = [None] * len(frames);
+
+    for i, image in zip(renderIndices, renderedImages):
+        images[i] = image;
+
+    renderIndices = set(renderIndices);
+
+    for i, (cacheFile, (_, _, fileName)) in enumerate(zip(cacheFiles, frames)):
+        if cacheFile == None:
+            continue;
+
+        if i in renderIndices:
+            _AddCachedCaptionedFrame(cacheFile, fileName, images[i]);
+        elif fileName != None:
+            shutil.copyfile(cacheFile, fileName);
+        else:
+            images[i] = _ReadPPMFile(cacheFile);
 
     totalTime = time.time() - startTime;
 
     # If the DebugMode flag is set, print the time taken for the rendering.
 
     if DebugMode:
-        print("DEBUG: _PrepareCaptionedAnimationFrames(): Rendered {0} frame(s) in {1:.2f} s".format(len(fileNames), totalTime));
+        print("DEBUG: _PrepareCaptionedAnimationFrames(): Rendered {0} frame(s) ({1} from cache) in {2:.2f} s".format(len(frames), len(frames) - len(renderIndices), totalTime));
+
+    # Return the list of file names or rendered frames.
+
+    return fileNames if fileNamePrefix != None else images;
+
+# Function to write a sequence of 'uint8' RGB images to an animated GIF using the in-memory encoder selected by GIFEncoder.
+
+def _WriteAnimatedGIF(images, outputFileName):
+    if GIFEncoder == 'wand':
+        # The MagickWand library stays loaded in the worker process, so unlike convert there is no start-up cost for each mode.
+
+        with WandImage() as animation:
+            for image in images:
+                with WandImage.from_array(image) as frame:
+                    animation.sequence.append(frame);
 
-    # Return the list of file names.
+            for i in range(0, len(animation.sequence)):
+                with animation.sequence[i] as frame:
+                    frame.delay = _AnimationFrameDelay;
 
-    return fileNames;
+            animation.loop = 0;
 
-# Function to read in an animation frame and render a captioned frame with Matplotlib.
-# This is called from _PrepareCaptionedAnimationFrames(), and was separated in order to a) keep the Matplotlib rendering code separate from the pre processing, and b) to enable possible multithreading in future.
+            animation.save(filename = outputFileName);
+    else:
+        images = [Image.fromarray(image) for image in images];
+
+        images[0].save(
+            outputFileName, format = 'GIF', save_all = True, append_images = images[1:], duration = 10 * _AnimationFrameDelay, loop = 0
+            );
 
-def _RenderCaptionedAnimationFrame(imageFile, caption, frameColour, outputPath):
-    # Record the start time for debugging purposes.
+# Function to caption the animation frames for a given mode and merge them into an animated GIF with a single Imagemagick convert command.
+# Each frame is scaled to fit the image area and padded with the frame colour, a band for the caption is added below it, and the caption is drawn in the band; this produces frames with the same layout as the other renderers without decoding or rendering any images in Python.
+
+def _GenerateCaptionedAnimationImagemagick(modeIndex, animationData, frameColour, outputFileName):
+    modeFrequencyTHz, modeFrequencyInvCm, modeAmplitudes, animationFrameImageFiles = animationData;
 
     startTime = time.time();
 
-    # Read the image file and record the time taken.
+    captions = _GenerateCaptions(modeIndex, modeFrequencyInvCm, modeAmplitudes);
+
+    frameW, frameH, imageAreaH, captionH = _GetCaptionedAnimationFrameLayout();
+
+    fontSize = _GetCaptionFontPixelSize();
+
+    frameColour = "rgb({0},{1},{2})".format(*[int(round(255.0 * component)) for component in to_rgb(frameColour)]);
+
+    # Build the command.
+    # The processing for each frame is enclosed in parentheses so that it is applied to that frame only.
+    # The arguments are passed directly to the program without going through a shell, so the parentheses and captions do not need to be escaped.
+
+    command = ["convert", "-delay", str(_AnimationFrameDelay), "-loop", "0"];
+
+    for caption, animationFrameImageFile in zip(captions, animationFrameImageFiles):
+        command.extend([
+            "(", animationFrameImageFile,
+            "-resize", "{0}x{1}".format(frameW, imageAreaH), "-background", frameColour, "-gravity", "center", "-extent", "{0}x{1}".format(frameW, imageAreaH),
+            "-gravity", "south", "-splice", "0x{0}".format(captionH),
+            "-font", _GetCaptionFontFile(), "-pointsize", str(fontSize), "-fill", "black", "-annotate", "+0+{0}".format(max(0, (captionH - fontSize) // 2)), caption,
+            "+repage", ")"
+            ]);
+
+    command.append(outputFileName);
+
+    subprocess.run(command, check = True);
+
+    totalTime = time.time() - startTime;
+
+    # If the DebugMode flag is set, print the time taken to generate the animation.
+
+    if DebugMode:
+        print("DEBUG: _GenerateCaptionedAnimationImagemagick(): Generated animation with {0} frame(s) in {1:.2f} s".format(len(captions), totalTime));
+
+# Function to choose the folder for the temporary captioned frames.
+# Returns _InMemoryTemporaryFolder if it exists and has at least requiredSize bytes free, and None (i.e. the system default) if not.
+
+def _GetTemporaryFolder(requiredSize):
+    if os.path.isdir(_InMemoryTemporaryFolder) and shutil.disk_usage(_InMemoryTemporaryFolder).free >= requiredSize:
+        return _InMemoryTemporaryFolder;
+
+    return None;
+
+# Function to generate the animated GIF for a given mode.
+# This is called from the Main block in a worker process, and does one of the following:
+# 1. With CaptionedFrameRenderer = 'imagemagick', captions the frames and merges them into the GIF with a single Imagemagick convert command, without rendering anything in Python.
+# 2. With GIFEncoder = 'pil' or 'wand', renders the captioned frames in memory using numProcesses processes and writes them to the GIF with PIL or Wand, without running convert.
+# 3. Otherwise, renders the captioned frames using numProcesses processes, saves them as PPM files to a temporary folder under temporaryFolder (None = the system default), and merges them with convert.
 
-    readStartTime = time.time();
+def _ProcessMode(modeIndex, animationData, frameColour, outputFileName, numProcesses, temporaryFolder = None):
+    if CaptionedFrameRenderer == 'imagemagick':
+        # Caption the frames and generate the animation in one step with Imagemagick.
 
-    image = _ReadAnimationFrame(imageFile);
+        _GenerateCaptionedAnimationImagemagick(modeIndex, animationData, frameColour, outputFileName);
+
+        return;
+
+    if GIFEncoder == 'pil' or GIFEncoder == 'wand':
+        # Render the captioned frames in memory and write them straight into an animated GIF.
+
+        images = _PrepareCaptionedAnimationFrames(
+            modeIndex, animationData, frameColour, None, numProcesses = numProcesses
+            );
 
-    readTime = time.time() - readStartTime;
+        _WriteAnimatedGIF(images, outputFileName);
 
-    # Draw the captioned image, again recording the time taken.
+        return;
 
-    drawStartTime = time.time();
+    # Prepare captioned animation frames.
+    # The frames are written to a temporary folder (in memory, if possible), which is unique to this mode and is removed along with the frames once the animation has been generated.
 
+    with tempfile.TemporaryDirectory(prefix = "GIFBuild-", dir = temporaryFolder) as modeTemporaryFolder:
+        fileNames = _PrepareCaptionedAnimationFrames(
+            modeIndex, animationData, frameColour, os.path.join(modeTemporaryFolder, "Frame"), numProcesses = numProcesses
+            );
+
+        # Merge into an animated GIF using Imagemagick.
+        # The command is run directly rather than through the shell, which avoids the cost (and the quoting issues) of parsing a very long command line.
+
+        subprocess.run(
+            ["convert", "-delay", str(_AnimationFrameDelay), "-loop", "0"] + fileNames + [outputFileName], check = True
+            );
+
+# Function to read in a batch of animation frames and render captioned frames with Matplotlib.
+# This is called from _PrepareCaptionedAnimationFrames(), and was separated in order to a) keep the Matplotlib rendering code separate from the pre processing, and b) to allow batches of frames to be rendered in parallel by a process pool.
+# The figure is set up once and reused for all the frames in the batch, which avoids creating the figure and artists and redoing the layout for every frame.
+# Frames with an output path are saved to PPM files; the others are returned as a list of 'uint8' RGB arrays.
+
+def _RenderCaptionedAnimationFrames(frames, frameColour, ppmHeader = None):
     # Fetch the dimentions for the captioned frame.
 
     plotW, plotH = _CaptionedAnimationFrameDimensions;
 
-    plt.figure(figsize = (plotW, plotH));
+    # The figure is drawn directly on an Agg canvas rather than created through pyplot, which avoids the overhead of pyplot's figure manager and does not require a display.
 
-    # Draw the image.
+    figure = Figure(figsize = (plotW, plotH), dpi = CaptionedFrameDPI, facecolor = frameColour);
 
-    axes1 = plt.subplot(2, 1, 1);
+    canvas = FigureCanvasAgg(figure);
 
-    plt.imshow(image, interpolation = 'bilinear');
+    # Create axes for the image.
 
-    # Add the caption.
+    axes = figure.add_subplot(1, 1, 1);
+
+    # Axis adjustments.
 
-    axes2 = plt.subplot(2, 1, 2);
+    axes.set_facecolor(frameColour);
 
-    axes2.add_artist(
-        AnchoredText(caption, loc = 10, frameon = False)
+    axes.set_xticks([]);
+    axes.set_yticks([]);
+
+    for spine in axes.spines.values():
+        spine.set_linewidth(0.0);
+
+    # Set the image area based on _CaptionedAnimationFrameCaptionHeight.
+
+    imageHeight = 1.0 - _CaptionedAnimationFrameCaptionHeight / plotH;
+
+    axes.set_position(
+        (0.0, 1.0 - imageHeight, 1.0, imageHeight)
         );
 
-    # Axis adjustments.
+    # Add the caption, centred in the area below the image; the text is set for each frame.
 
-    for axes in axes1, axes2:
-        axes.set_facecolor(frameColour);
+    captionText = figure.text(
+        0.5, _CaptionedAnimationFrameCaptionHeight / (2.0 * plotH), "", ha = 'center', va = 'center'
+        );
 
-        axes.set_xticks([]);
-        axes.set_yticks([]);
+    # Render the frames.
 
-        for spine in axes.spines.values():
-            spine.set_linewidth(0.0);
+    imagePlot, images = None, [];
 
-    # "Magic" layout function.
+    frameImages = _ReadAnimationFramesPrefetch(
+        [imageFile for imageFile, _, _ in frames], ppmHeader
+        );
 
-    plt.tight_layout();
+    for imageFile, caption, outputPath in frames:
+        # Record the start time for debugging purposes.
 
-    # Adjust the image area based on _CaptionedAnimationFrameCaptionHeight.
+        startTime = time.time();
 
-    imageHeight = 1.0 - _CaptionedAnimationFrameCaptionHeight / plotH;
+        # Fetch the image (read in the background) and record the time taken.
 
-    axes1.set_position(
-        (0.0, 1.0 - imageHeight, 1.0, imageHeight)
+        readStartTime = time.time();
+
+        image = next(frameImages);
+
+        readTime = time.time() - readStartTime;
+
+        # Draw the captioned image, again recording the time taken.
+
+        drawStartTime = time.time();
+
+        # Draw the image.
+        # The image artist is created for the first frame, and the image data is replaced for subsequent frames (the frames in a sequence all have the same dimensions).
+
+        if imagePlot == None or imagePlot.get_array().shape != image.shape:
+            if imagePlot != None:
+                imagePlot.remove();
+
+            imagePlot = axes.imshow(image, interpolation = 'bilinear');
+        else:
+            imagePlot.set_data(image);
+
+        # Update the caption.
+
+        captionText.set_text(caption);
+
+        # Draw the frame and save or store the image.
+
+        canvas.draw();
+
+        image = np.asarray(canvas.buffer_rgba())[:, :, :3];
+
+        if outputPath != None:
+            _WritePPMFile(outputPath, image);
+        else:
+            # The canvas buffer is reused for the next frame, so we need to store a copy.
+
+            images.append(
+                image.copy()
+                );
+
+        drawTime = time.time() - drawStartTime;
+
+        functionTime = time.time() - startTime;
+
+        # If the DebugMode flag is set, print out timing information from the reading/drawing parts of the function.
+
+        if DebugMode:
+            print("DEBUG: _RenderCaptionedAnimationFrames(): Read = {0:.2f} s ({1:.2f} %), Draw = {2:.2f} s ({3:.2f} %)".format(readTime, 100.0 * readTime / functionTime, drawTime, 100.0 * drawTime / functionTime));
+
+    return images;
+
+# Function to work out the pixel dimensions of the captioned frames for the PIL and Imagemagick renderers.
+# Returns a tuple of (frameW, frameH, imageAreaH, captionH), which match the dimensions of the frames drawn by Matplotlib.
+
+def _GetCaptionedAnimationFrameLayout():
+    plotW, plotH = _CaptionedAnimationFrameDimensions;
+
+    frameW = int(plotW * CaptionedFrameDPI);
+    frameH = int(plotH * CaptionedFrameDPI);
+
+    captionH = int(round(_CaptionedAnimationFrameCaptionHeight * CaptionedFrameDPI));
+
+    return (frameW, frameH, frameH - captionH, captionH);
+
+# Functions to locate the caption font file and determine the font size (pixels) for the PIL and Imagemagick renderers, and to load the font for the PIL renderer.
+# The font is located and loaded once in each process.
+
+@functools.lru_cache(maxsize = None)
+def _GetCaptionFontFile():
+    # Use the same font as the Matplotlib renderer if available; if not, findfont() falls back to a font distributed with Matplotlib.
+
+    return findfont(
+        FontProperties(family = ['Courier New', 'monospace'])
         );
 
-    axes2.set_position(
-        (0.0, 0.0, 1.0, 1.0 - imageHeight)
+def _GetCaptionFontPixelSize():
+    return int(round(_CaptionFontSize * CaptionedFrameDPI / 72.0));
+
+@functools.lru_cache(maxsize = None)
+def _GetPILCaptionFont():
+    return ImageFont.truetype(
+        _GetCaptionFontFile(), _GetCaptionFontPixelSize()
         );
 
-    # Save and clean up.
+# Function to read in a batch of animation frames and render captioned frames by compositing them directly with PIL.
+# This produces frames of the same dimensions as _RenderCaptionedAnimationFrames(), but avoids the overhead of drawing a Matplotlib figure for every frame.
+# As for _RenderCaptionedAnimationFrames(), frames with an output path are saved to PPM files and the others are returned as a list of 'uint8' RGB arrays.
+
+def _RenderCaptionedAnimationFramesPIL(frames, frameColour, ppmHeader = None):
+    # Work out the pixel dimensions of the frame, caption and image area.
 
-    plt.savefig(outputPath, format = 'png', dpi = 200, facecolor = frameColour);
-    plt.close();
+    frameW, frameH, imageAreaH, captionH = _GetCaptionedAnimationFrameLayout();
 
-    drawTime = time.time() - drawStartTime;
+    # Create a blank frame to use as a template.
 
-    functionTime = time.time() - startTime;
+    template = Image.new(
+        'RGB', (frameW, frameH), tuple(int(round(255.0 * component)) for component in to_rgb(frameColour))
+        );
 
-    # If the DebugMode flag is set, print out timing information from the reading/drawing parts of the function.
+    font = _GetPILCaptionFont();
 
-    if DebugMode:
-        print("DEBUG: _RenderCaptionedAnimationFrame(): Read = {0:.2f} s ({1:.2f} %), Draw = {2:.2f} s ({3:.2f} %)".format(readTime, 100.0 * readTime / functionTime, drawTime, 100.0 * drawTime / functionTime));
+    # Render the frames.
+
+    images = [];
+
+    frameImages = _ReadAnimationFramesPrefetch(
+        [imageFile for imageFile, _, _ in frames], ppmHeader
+        );
+
+    for imageFile, caption, outputPath in frames:
+        # Record the start time for debugging purposes.
+
+        startTime = time.time();
+
+        # Fetch the image (read in the background) and record the time taken.
+
+        readStartTime = time.time();
+
+        image = Image.fromarray(next(frameImages));
+
+        readTime = time.time() - readStartTime;
+
+        # Draw the captioned image, again recording the time taken.
+
+        drawStartTime = time.time();
+
+        canvas = template.copy();
+
+        # Scale the image to fit the image area, preserving the aspect ratio, and paste it in the centre.
+
+        imageW, imageH = image.size;
+
+        scale = min(float(frameW) / imageW, float(imageAreaH) / imageH);
+
+        scaledW, scaledH = max(1, int(round(imageW * scale))), max(1, int(round(imageH * scale)));
+
+        if (scaledW, scaledH) != (imageW, imageH):
+            image = image.resize((scaledW, scaledH), Image.BILINEAR);
+
+        canvas.paste(
+            image, ((frameW - scaledW) // 2, (imageAreaH - scaledH) // 2)
+            );
+
+        # Add the caption, centred in the area below the image.
+
+        ImageDraw.Draw(canvas).text(
+            (frameW // 2, imageAreaH + captionH // 2), caption, font = font, fill = (0, 0, 0), anchor = 'mm'
+            );
+
+        # Save or store the image.
+
+        if outputPath != None:
+            _WritePPMFile(outputPath, np.asarray(canvas));
+        else:
+            images.append(
+                np.asarray(canvas)
+                );
+
+        drawTime = time.time() - drawStartTime;
+
+        functionTime = time.time() - startTime;
+
+        # If the DebugMode flag is set, print out timing information from the reading/drawing parts of the function.
+
+        if DebugMode:
+            print("DEBUG: _RenderCaptionedAnimationFramesPIL(): Read = {0:.2f} s ({1:.2f} %), Draw = {2:.2f} s ({3:.2f} %)".format(readTime, 100.0 * readTime / functionTime, drawTime, 100.0 * drawTime / functionTime));
+
+    return images;
 
 
 # ----
@@ -340,25 +926,29 @@ if __name__ == "__main__":
 
     imageFiles = [];
 
-    for entry in os.listdir(AnimationFrameImageFolder):
-        absPath = os.path.join(AnimationFrameImageFolder, entry);
+    # Match file names against a regex built from the prefix and extension.
+    # os.scandir() caches the file type of each entry, which avoids an extra stat() call per file compared to os.listdir() + os.path.isfile().
 
-        if os.path.isfile(absPath):
-            root, ext = os.path.splitext(entry);
+    imageFileRegex = re.compile(
+        re.escape(AnimationFramePrefix) + r"\.(?P<file_number>\d+)" + re.escape(AnimationFrameExtension) + r"$"
+        );
 
-            if ext == AnimationFrameExtension:
-                components = root.split('.');
+    with os.scandir(AnimationFrameImageFolder) as entries:
+        for entry in entries:
+            match = imageFileRegex.match(entry.name);
 
-                if len(components) >= 2 and '.'.join(components[:-1]) == AnimationFramePrefix:
-                    # To ensure the files will sort into the right numerical order, we convert the file number to an integer and store it with the file name in a tuple.
+            if match and entry.is_file():
+                # To ensure the files will sort into the right numerical order, we convert the file number to an integer and store it with the file name in a tuple.
 
-                    imageFiles.append(
-                        (int(components[-1]), entry)
-                        );
+                imageFiles.append(
+                    (int(match.group('file_number')), entry.name)
+                    );
 
     # Sort by file number and strip the numbers from the file list.
 
-    imageFiles = [os.path.join(AnimationFrameImageFolder, fileName) for _, fileName in sorted(imageFiles)];
+    imageFiles.sort(key = itemgetter(0));
+
+    imageFiles = [os.path.join(AnimationFrameImageFolder, fileName) for _, fileName in imageFiles];
 
     # Calculate the actual number of animation frames.
 
@@ -393,12 +983,20 @@ if __name__ == "__main__":
 
     # Generate animations.
 
-    # Initialise Matplotlib.
+    # Sanity check.
 
-    fontSize = 8;
+    if CaptionedFrameRenderer not in _CaptionFormatStrings:
+        raise Exception("Error: CaptionedFrameRenderer must be one of {0}.".format(", ".join("'{0}'".format(key) for key in sorted(_CaptionFormatStrings.keys()))));
 
-    mpl.rc('font', **{ 'family' : 'serif', 'size' : fontSize, 'serif' : 'Courier New' });
-    mpl.rc('mathtext', **{ 'fontset' : 'custom', 'rm' : 'Courier New', 'it' : 'Courier New:it', 'bf' : 'Courier New:bold' });
+    if GIFEncoder not in _GIFEncoders:
+        raise Exception("Error: GIFEncoder must be one of {0}.".format(", ".join("'{0}'".format(encoder) for encoder in _GIFEncoders)));
+
+    if GIFEncoder == 'wand' and WandImage == None:
+        raise Exception("Error: GIFEncoder = 'wand' requires the Wand package (and the Imagemagick MagickWand library).");
+
+    # Initialise Matplotlib.
+
+    _InitialiseMatplotlib();
 
     print("Generating animations...");
 
@@ -407,22 +1005,28 @@ if __name__ == "__main__":
     if AnimationFrameBackgroundColour == None:
         image = _ReadAnimationFrame(imageFiles[0]);
 
-        # To get the modal pixel colour using the scipy.stats mode() function, we first need to reshape the array to (width * height) x depth.
+        # The background surrounds the structure, so we only need to sample the pixels around the edge of the image.
 
-        width, height, depth = image.shape;
+        height, width, depth = image.shape;
 
-        modeResult = mode(
-            image.reshape((width * height, 3))
-            );
+        borderWidth = _BackgroundColourBorderWidth;
 
-        # With this input data, mode() returns a 1 x depth NumPy array, which needs to be converted to a 1D array before being used as a Matplotlib colour.
+        if height > 2 * borderWidth and width > 2 * borderWidth:
+            pixels = np.concatenate([
+                image[:borderWidth].reshape((-1, 3)), image[-borderWidth:].reshape((-1, 3)),
+                image[borderWidth:-borderWidth, :borderWidth].reshape((-1, 3)), image[borderWidth:-borderWidth, -borderWidth:].reshape((-1, 3))
+                ]);
+        else:
+            pixels = image;
 
-        AnimationFrameBackgroundColour = modeResult.mode[0, :];
+        AnimationFrameBackgroundColour = _GetModalPixelColour(pixels);
 
         print("  -> INFO: AnimationFrameBackgroundColour set to ({0:.2f}, {1:.2f}, {2:.2f})".format(*AnimationFrameBackgroundColour));
         print("");
 
-    # Loop over modes.
+    # Loop over modes and build a list of animations to generate.
+
+    modeJobs = [];
 
     for modeIndex in sorted(animationData.keys()):
         outputFileName = "{0}-Mode{1:0>3}.gif".format(OutputPrefix, modeIndex);
@@ -433,21 +1037,48 @@ if __name__ == "__main__":
         if not OverwriteExisting and os.path.isfile(outputFileName):
             print("  -> INFO: \"{0}\" already exists -> skipping...".format(outputFileName));
         else:
-            print("  -> Generating animaton for Mode {0}".format(modeIndex));
+            modeJobs.append(
+                (modeIndex, outputFileName)
+                );
 
-            # Prepare captioned animation frames.
+    if len(modeJobs) > 0:
+        # The modes are independent, so we process them in parallel.
+        # This overlaps the rendering of the frames for one mode with the Imagemagick encoding of another.
+        # The available processes are divided between the modes (outer) and the frame rendering for each mode (inner).
 
-            fileNames = _PrepareCaptionedAnimationFrames(modeIndex, animationData[modeIndex], AnimationFrameBackgroundColour, "GIFBuild-Temp");
+        numProcesses = NumProcesses if NumProcesses != None else os.cpu_count();
 
-            # Merge into an animated GIF using Imagemagick.
+        numModeProcesses = min(len(modeJobs), max(1, numProcesses // 2));
+        numFrameProcesses = max(1, numProcesses // numModeProcesses);
 
-            os.system(
-                "convert -delay 10 -loop 0 " + " ".join(fileNames) + " {0}".format(outputFileName)
-                );
+        # If the captioned frames are saved to temporary files, check that the in-memory temporary folder has enough space for the frames for all the modes processed at once; if not, the system default is used.
+        # The frames are saved as PPM files, so the size is (close to) width x height x 3 bytes per frame.
+
+        temporaryFolder = None;
+
+        if CaptionedFrameRenderer != 'imagemagick' and GIFEncoder == 'imagemagick':
+            frameW, frameH, _, _ = _GetCaptionedAnimationFrameLayout();
+
+            maxNumFrames = max(len(animationData[modeIndex][3]) for modeIndex, _ in modeJobs);
+
+            temporaryFolder = _GetTemporaryFolder(maxNumFrames * frameW * frameH * 3 * numModeProcesses);
+
+            if temporaryFolder == None and os.path.isdir(_InMemoryTemporaryFolder):
+                print("  -> INFO: Not enough free space in \"{0}\" for temporary frames -> using the default temporary folder".format(_InMemoryTemporaryFolder));
+
+        with ProcessPoolExecutor(max_workers = numModeProcesses, initializer = _InitialiseMatplotlib) as executor:
+            futures = [];
+
+            for modeIndex, outputFileName in modeJobs:
+                print("  -> Generating animaton for Mode {0}".format(modeIndex));
+
+                futures.append(
+                    executor.submit(_ProcessMode, modeIndex, animationData[modeIndex], AnimationFrameBackgroundColour, outputFileName, numFrameProcesses, temporaryFolder)
+                    );
 
-            # Remove the temporary files.
+            # Wait for the modes to complete; calling result() re-raises any exceptions from the worker processes.
 
-            for fileName in fileNames:
-                os.remove(fileName);
+            for future in futures:
+                future.result();
 
     print("");
@@ -70,30 +70,78 @@ OutputPrefix = "MolecularCrystal";
 # Imports
 # -------
 
+import contextlib;
+import hashlib;
+import io;
+import itertools;
 import math;
+import mmap;
 import os;
-import pickle;
 import tarfile;
 import time;
+import zipfile;
 
 import yaml;
 
 import numpy as np;
 
+# SciPy is used to speed up the bond search if available; if not, a compiled Numba kernel is used if Numba is available, and a (slower) NumPy implementation if not.
+# Numba is only imported if SciPy is not available, since importing it takes a noticeable amount of time.
+
+numba = None;
+
+try:
+    from scipy.spatial import cKDTree;
+except ImportError:
+    cKDTree = None;
+
+    try:
+        import numba;
+    except ImportError:
+        pass;
+
+# The animation archive is compressed with Zstandard if the zstandard module is available, and with gzip if not.
+
+try:
+    import zstandard;
+except ImportError:
+    zstandard = None;
+
+# Use the (much faster) libyaml-based loader if PyYAML was built with it, and fall back to the pure-Python loader if not.
+
+try:
+    from yaml import CSafeLoader as _YAMLLoader;
+except ImportError:
+    from yaml import SafeLoader as _YAMLLoader;
+
 
 # ---------
 # Constants
 # ---------
 
-_PickleDumpFile = r"MolecularCrystalPhononAnimation.bin";
+_DumpFile = r"MolecularCrystalPhononAnimation.npz";
+
+# Pickle dump file written by older versions of the script; this is no longer read and is removed if present.
+
+_LegacyDumpFile = r"MolecularCrystalPhononAnimation.bin";
 
 # Value taken from: http://halas.rice.edu/conversions (accessed 3/4/2017).
 
 _THzToInverseCm = 33.35641;
 
-# Workaround for an intermittent permissions error on Windows - see below.
+# Block size (bytes) for reading the input file to compute the hash used to validate _DumpFile.
+
+_FileHashBlockSize = 1024 * 1024;
+
+# Compression levels for the animation archive.
+# The XYZ files compress well, so a low level gives a similar ratio to the (gzip) default of 9 in a fraction of the time.
 
-_DeleteFilePermissionErrorDelay = 0.5;
+_ArchiveCompressionLevelZstandard = 3;
+_ArchiveCompressionLevelGzip = 3;
+
+# Number of atoms processed at once by the NumPy implementation of _FindAtomPairs().
+
+_FindAtomPairsBlockSize = 1024;
 
 
 # ---------
@@ -107,21 +155,28 @@ def _ReadYAMLFile(filePath):
 
     # Parse the input file.
 
-    with open(filePath) as inputReader:
-        inputYAML = yaml.load(inputReader);
+    # The file is memory mapped and the raw bytes passed to the loader, which decodes them directly; this avoids holding a copy of the (potentially very large) file in Python's I/O buffers.
 
-        # Read the lattice vectors.
+    with open(filePath, 'rb') as inputReader:
+        with mmap.mmap(inputReader.fileno(), 0, access = mmap.ACCESS_READ) as inputData:
+            inputYAML = yaml.load(inputData, Loader = _YAMLLoader);
 
-        latticeVectors = [
-            np.array(vector, dtype = np.float64) for vector in inputYAML['lattice']
-            ];
+        # Read the lattice vectors into a 3 x 3 matrix with the vectors as rows.
+
+        latticeVectors = np.array(inputYAML['lattice'], dtype = np.float64);
 
         # Read the atomic symbols (atom types) positions and masses.
+        # The positions are stored as an (nAtoms, 3) array.
 
         atomTypes = [atom['symbol'] for atom in inputYAML['atoms']];
-        atomPositions = [np.array(atom['position'], dtype = np.float64) for atom in inputYAML['atoms']];
 
-        sqrtAtomicMasses = [math.sqrt(atom['mass']) for atom in inputYAML['atoms']];
+        atomPositions = np.array(
+            [atom['position'] for atom in inputYAML['atoms']], dtype = np.float64
+            );
+
+        sqrtAtomicMasses = np.sqrt(
+            np.array([atom['mass'] for atom in inputYAML['atoms']], dtype = np.float64)
+            );
 
         # Scan the file for Gamma-point frequencies and eigenvectors.
 
@@ -129,21 +184,20 @@ def _ReadYAMLFile(filePath):
             qx, qy, qz = qPoint['q-position'];
 
             if qx == qy == qz == 0.0:
-                frequencies, eigenvectors = [], [];
+                bands = qPoint['band'];
 
-                for band in qPoint['band']:
-                    frequencies.append(band['frequency']);
+                frequencies = [band['frequency'] for band in bands];
 
-                    eigenvector = [];
+                # Store the eigenvectors as an (nModes, nAtoms, 3) array.
+                # As well as being more convenient to work with, this allows them (and the eigendisplacements) to be stored in _DumpFile as large arrays.
 
-                    for i, component in enumerate(band['eigenvector']):
-                        # The Gamma-point eigenvectors are real, so we only need to store the real part of the complex numbers.
+                eigenvectors = np.zeros((len(bands), len(atomTypes), 3), dtype = np.float64);
 
-                        eigenvector.append(
-                            np.array([item[0] for item in component], dtype = np.float64)
-                            );
+                for i, band in enumerate(bands):
+                    # Each eigenvector is an nAtoms x 3 list of (real, imaginary) pairs.
+                    # The Gamma-point eigenvectors are real, so we only need to store the real part of the complex numbers.
 
-                    eigenvectors.append(eigenvector);
+                    eigenvectors[i] = np.asarray(band['eigenvector'], dtype = np.float64)[:, :, 0];
 
                 break;
 
@@ -154,14 +208,7 @@ def _ReadYAMLFile(filePath):
 
     # Divide the eigenvector components by sqrt(mass) to generate the eigendisplacements.
 
-    eigendisplacements = [];
-
-    for eigenvector in eigenvectors:
-        eigensdisplacement = [
-            component / sqrtAtomicMasses[i] for i, component in enumerate(eigenvector)
-            ];
-
-        eigendisplacements.append(eigensdisplacement);
+    eigendisplacements = eigenvectors / sqrtAtomicMasses[np.newaxis, :, np.newaxis];
 
     # Return the data.
 
@@ -170,28 +217,184 @@ def _ReadYAMLFile(filePath):
         (frequencies, eigenvectors, eigendisplacements)
         );
 
+def _GetFileHash(filePath):
+    # Compute an MD5 hash of the contents of a file, reading it in blocks.
+
+    fileHash = hashlib.md5();
+
+    with open(filePath, 'rb') as inputReader:
+        for block in iter(lambda: inputReader.read(_FileHashBlockSize), b""):
+            fileHash.update(block);
+
+    return fileHash.hexdigest();
+
+def _WriteDumpFile(filePath, fileHash, structure, phononModes):
+    # The data is stored as a set of NumPy arrays in an (uncompressed) .npz file, which can be loaded without parsing or unpickling any Python objects.
+
+    latticeVectors, atomTypes, atomPositions = structure;
+    frequencies, eigenvectors, eigendisplacements = phononModes;
+
+    np.savez(
+        filePath, file_hash = np.array(fileHash), lattice_vectors = latticeVectors, atom_types = np.array(atomTypes), atom_positions = atomPositions,
+        frequencies = np.array(frequencies, dtype = np.float64), eigenvectors = eigenvectors, eigendisplacements = eigendisplacements
+        );
+
+def _ReadDumpFile(filePath):
+    # Returns the hash of the input file stored in the dump file along with the structure and phonon-mode data.
+
+    with np.load(filePath) as dumpFile:
+        return (
+            str(dumpFile['file_hash']),
+            (dumpFile['lattice_vectors'], dumpFile['atom_types'].tolist(), dumpFile['atom_positions']),
+            (dumpFile['frequencies'].tolist(), dumpFile['eigenvectors'], dumpFile['eigendisplacements'])
+            );
+
+def _GetBondDistance(type1, type2, bondDistances):
+    # Search for the specific pair first, then pairs with one wildcard, then the pair with both wildcards.
+    # The keys in bondDistances should be "canonicalised" (sorted).
+
+    for pair in [(type1, type2), (type1, 'X'), ('X', type2), ('X', 'X')]:
+        key = '-'.join(sorted(pair));
+
+        if key in bondDistances:
+            return bondDistances[key];
+
+    return None;
+
+def _FindAtomPairs(positions1, positions2, maxDistance):
+    # Returns the indices of the pairs of positions in the (N, 3) arrays positions1 and positions2 that are within maxDistance of each other, and the squared distances between them.
+
+    if cKDTree != None:
+        pairs = cKDTree(positions1).sparse_distance_matrix(
+            cKDTree(positions2), maxDistance, output_type = 'ndarray'
+            );
+
+        return (pairs['i'], pairs['j'], pairs['v'] ** 2);
+
+    # If SciPy is not available, compute the squared distances between blocks of positions1 and all of positions2 with NumPy.
+
+    indices1, indices2, distances = [], [], [];
+
+    for blockStart in range(0, len(positions1), _FindAtomPairsBlockSize):
+        blockDistances = (
+            (positions1[blockStart:blockStart + _FindAtomPairsBlockSize, np.newaxis, :] - positions2[np.newaxis, :, :]) ** 2
+            ).sum(axis = 2);
+
+        blockIndices1, blockIndices2 = np.nonzero(blockDistances <= maxDistance ** 2);
+
+        indices1.append(blockIndices1 + blockStart);
+        indices2.append(blockIndices2);
+        distances.append(blockDistances[blockIndices1, blockIndices2]);
+
+    if len(indices1) == 0:
+        return (np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.intp), np.zeros(0, dtype = np.float64));
+
+    return (np.concatenate(indices1), np.concatenate(indices2), np.concatenate(distances));
+
+# Numba implementation of the bond search in _FindBondedAtoms(), used if SciPy is not available.
+# The atoms in positions1 are processed in parallel.
+
+if numba != None:
+    @numba.njit(parallel = True, fastmath = True, cache = True)
+    def _FindBondedAtomsNumba(positions1, typeIndices1, positions2, typeIndices2, bondDistances2):
+        bonded = np.zeros(positions1.shape[0], dtype = np.bool_);
+
+        for i in numba.prange(positions1.shape[0]):
+            typeIndex1 = typeIndices1[i];
+
+            for j in range(positions2.shape[0]):
+                dx = positions1[i, 0] - positions2[j, 0];
+                dy = positions1[i, 1] - positions2[j, 1];
+                dz = positions1[i, 2] - positions2[j, 2];
+
+                if dx * dx + dy * dy + dz * dz <= bondDistances2[typeIndex1, typeIndices2[j]]:
+                    bonded[i] = True;
+                    break;
+
+        return bonded;
+
+def _FindBondedAtoms(positions1, typeIndices1, positions2, typeIndices2, bondDistances2, maxBondDistance):
+    # Determines which atoms in positions1 are bonded to at least one atom in positions2, using the table of squared reference bond distances bondDistances2 indexed by the atom types in typeIndices1/typeIndices2.
+    # Pairs with no reference distance should have the distance set to -1, so they are never bonded.
+    # Returns a boolean mask over positions1.
+
+    if cKDTree == None and numba != None:
+        return _FindBondedAtomsNumba(positions1, typeIndices1, positions2, typeIndices2, bondDistances2);
+
+    pairIndices1, pairIndices2, pairDistances2 = _FindAtomPairs(positions1, positions2, maxBondDistance);
+
+    # Look up the reference bond distances for each pair and compare.
+
+    pairBondDistances2 = bondDistances2[typeIndices1[pairIndices1], typeIndices2[pairIndices2]];
+
+    bonded = np.zeros(len(positions1), dtype = bool);
+
+    bonded[pairIndices1[pairDistances2 <= pairBondDistances2]] = True;
+
+    return bonded;
+
+@contextlib.contextmanager
+def _OpenArchiveFile(filePath):
+    # Open a compressed tar archive for writing.
+    # If the zstandard module is available, the archive is compressed with (multithreaded) Zstandard; if not, it is compressed with gzip.
+
+    if zstandard != None:
+        with open(filePath, 'wb') as outputWriter:
+            with zstandard.ZstdCompressor(level = _ArchiveCompressionLevelZstandard, threads = -1).stream_writer(outputWriter, closefd = False) as compressionWriter:
+                with tarfile.open(fileobj = compressionWriter, mode = 'w|') as archiveFile:
+                    yield archiveFile;
+    else:
+        with tarfile.open(filePath, 'w:gz', compresslevel = _ArchiveCompressionLevelGzip) as archiveFile:
+            yield archiveFile;
+
 def _WriteXYZFile(atomTypes, atomPositionSets, filePath, commentLines = None):
-    # Sanity checks.
+    # filePath can also be a text-mode file-like object, e.g. an io.StringIO buffer.
+    # atomPositionSets and commentLines can be any iterables (e.g. generators), and are consumed one frame at a time.
 
-    if commentLines != None and len(commentLines) != len(atomPositionSets):
-        raise Exception("Error: If supplied, commentLines must contain the same number of entries as atomPositionSets.");
+    if isinstance(filePath, str):
+        with open(filePath, 'w') as outputWriter:
+            _WriteXYZFile(atomTypes, atomPositionSets, outputWriter, commentLines);
 
-    for i, atomPositionSet in enumerate(atomPositionSets):
-        if len(atomPositionSet) != len(atomTypes):
-            raise Exception("Error: Atom position set {0} is does not contain the same number of elements as atomTypes.".format(i + 1));
+        return;
 
     # Write out the data in the XYZ format.
 
     atomCountLine = "{0}\n".format(len(atomTypes));
 
-    with open(filePath, 'w') as outputWriter:
-        for atomPositionSet, commentLine in zip(atomPositionSets, commentLines):
-            outputWriter.write(atomCountLine);
+    # The atom types are the same in each frame, so we build a format string for the atom lines in a frame with the atom types filled in, and format each frame with a single call.
+
+    atomLinesFormatString = "".join(
+        "  {0: >3}  {{: 16.10f}}  {{: 16.10f}}  {{: 16.10f}}\n".format(atomType) for atomType in atomTypes
+        );
+
+    outputWriter = filePath;
+
+    # If commentLines is not supplied, the comment lines are left blank.
+
+    commentLineIterator = iter(commentLines) if commentLines != None else itertools.repeat("");
+
+    for i, atomPositionSet in enumerate(atomPositionSets):
+        # Sanity checks.
+        # Since the data may be generated on the fly, these are performed as each frame is written.
+
+        commentLine = next(commentLineIterator, None);
 
-            outputWriter.write("{0}\n".format(commentLine));
+        if commentLine == None:
+            raise Exception("Error: If supplied, commentLines must contain the same number of entries as atomPositionSets.");
 
-            for atomType, (x, y, z) in zip(atomTypes, atomPositionSet):
-                outputWriter.write("  {0: >3}  {1: 16.10f}  {2: 16.10f}  {3: 16.10f}\n".format(atomType, x, y, z));
+        if len(atomPositionSet) != len(atomTypes):
+            raise Exception("Error: Atom position set {0} is does not contain the same number of elements as atomTypes.".format(i + 1));
+
+        outputWriter.write(atomCountLine);
+
+        outputWriter.write("{0}\n".format(commentLine));
+
+        outputWriter.write(
+            atomLinesFormatString.format(*np.ravel(atomPositionSet).tolist())
+            );
+
+    if commentLines != None and next(commentLineIterator, None) != None:
+        raise Exception("Error: If supplied, commentLines must contain the same number of entries as atomPositionSets.");
 
 
 # ----
@@ -209,37 +412,42 @@ if __name__ == "__main__":
 
     structure, phononModes = None, None;
 
-    # Since parsing YAML files is very slow, we pickle the data for faster loading next time the script is run.
-    # The dump stores the path to the input file, which we use to (in)validate the dump.
+    # Since parsing YAML files is very slow, we store the data in a dump file for faster loading next time the script is run.
+    # The dump stores a hash of the contents of the input file, which we use to (in)validate the dump; this means the dump is still used if the input file is moved or renamed, and is not used if it is modified.
+
+    inputFileHash = _GetFileHash(InputFile);
+
+    # Clean up the dump file from older versions of the script, if present.
 
-    # If _PickleDumpFile is present, read it and see whether the stored file path matches InputFile.
+    if os.path.isfile(_LegacyDumpFile):
+        os.remove(_LegacyDumpFile);
 
-    if os.path.isfile(_PickleDumpFile):
-        pFilePath, pStructure, pPhononModes = None, None, None;
+        print("  -> INFO: Removed legacy dump file {0}".format(_LegacyDumpFile));
 
+    # If _DumpFile is present, read it and see whether the stored hash matches that of InputFile.
+
+    if os.path.isfile(_DumpFile):
         try:
-            with open(_PickleDumpFile, 'rb') as inputReader:
-                pFilePath, pStructure, pPhononModes = pickle.load(inputReader);
+            dFileHash, dStructure, dPhononModes = _ReadDumpFile(_DumpFile);
 
-            if pFilePath == InputFile:
-                # If the file path matches, use the unpickled data.
+            if dFileHash == inputFileHash:
+                # If the hash matches, use the stored data.
 
-                structure, phononModes = pStructure, pPhononModes;
+                structure, phononModes = dStructure, dPhononModes;
 
-                print("  -> INFO: Loaded pickled data from {0}".format(_PickleDumpFile));
+                print("  -> INFO: Loaded data from dump file {0}".format(_DumpFile));
             else:
                 # If not, remove the "stale" dump file.
 
-                os.remove(_PickleDumpFile);
+                os.remove(_DumpFile);
 
-                print("  -> INFO: Removed \"stale\" pickle dump file {0}".format(_PickleDumpFile));
-        except UnicodeDecodeError:
-            # Reading pickle dump files can fail with a UnicodeDecodeError due to incompatibilities between major versions of Python.
-            # If this happens, delete the file and try re-reading the source.
+                print("  -> INFO: Removed \"stale\" dump file {0}".format(_DumpFile));
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # If the dump file cannot be read (e.g. if it is incomplete), delete it and try re-reading the source.
 
-            os.remove(_PickleDumpFile);
+            os.remove(_DumpFile);
 
-            print("  -> INFO: An error occurred while reading pickle dump file {0} -> it has been deleted".format(_PickleDumpFile));
+            print("  -> INFO: An error occurred while reading dump file {0} -> it has been deleted".format(_DumpFile));
 
     # If required, read and parse the input file.
 
@@ -248,14 +456,11 @@ if __name__ == "__main__":
 
         structure, phononModes = _ReadYAMLFile(InputFile);
 
-        # Store the data to a pickle dump file.
+        # Store the data to a dump file.
 
-        with open(_PickleDumpFile, 'wb') as outputWriter:
-            pickle.dump(
-                (InputFile, structure, phononModes), outputWriter
-                );
+        _WriteDumpFile(_DumpFile, inputFileHash, structure, phononModes);
 
-            print("  -> INFO: Pickled data to dump file {0}".format(_PickleDumpFile));
+        print("  -> INFO: Stored data to dump file {0}".format(_DumpFile));
 
     latticeVectors, atomTypes, atomPositions = structure;
     frequencies, eigenvectors, eigendisplacements = phononModes;
@@ -276,42 +481,39 @@ if __name__ == "__main__":
 
     scDim1, scDim2, scDim3 = StructureExpansionSC;
 
-    # scAtomMappings keeps track of how the atoms in the supercell map onto the atoms in the original cell.
+    # Generate the (x, y, z) translation vectors for the unit cells in the supercell.
+    # The translations are ordered with x varying fastest and z slowest, so the base unit cell is at the centre of the list.
 
-    scAtomPositions, scAtomMappings = [], [];
+    scVectors = np.mgrid[
+        -scDim3:scDim3 + 1, -scDim2:scDim2 + 1, -scDim1:scDim1 + 1
+        ].reshape(3, -1).T[:, ::-1].astype(np.float64);
 
-    for z in range(-scDim3, scDim3 + 1):
-        for y in range(-scDim2, scDim2 + 1):
-            for x in range(-scDim1, scDim1 + 1):
-                scVector = np.array([x, y, z], dtype = np.float64);
+    # scAtomMappings keeps track of how the atoms in the supercell map onto the atoms in the original cell.
 
-                scAtomPositions.extend(
-                    [position + scVector for position in atomPositions]
-                    );
+    scAtomPositions = (
+        atomPositions[np.newaxis, :, :] + scVectors[:, np.newaxis, :]
+        ).reshape(-1, 3);
 
-                scAtomMappings.extend(
-                    [i for i in range(0, nAtoms)]
-                    );
+    scAtomMappings = np.tile(
+        np.arange(nAtoms, dtype = np.int32), len(scVectors)
+        );
 
     # Convert the positions from fractional to cartesian coordinates.
+    # The rows of the lattice matrix are the lattice vectors, so this is a single matrix multiplication.
 
-    a, b, c = latticeVectors;
-
-    scAtomPositionsCart = [a * fA + b * fB + c * fC for fA, fB, fC in scAtomPositions];
+    scAtomPositionsCart = np.dot(scAtomPositions, latticeVectors);
 
     # We need to generate a list of atoms to include in the expansion, and their mapping to atoms in the original cell.
+    # expAtomIndices records the indices of the atoms in the supercell included in the expansion, in the order they are added, and includedAtoms flags them.
 
     # First we add the atoms corresponding to the base unit cell (at the centre of the supercell expansion).
 
     baseIndex = (len(scAtomPositions) - nAtoms) // 2;
 
-    expAtomPositions = scAtomPositionsCart[baseIndex:baseIndex + nAtoms];
-    expAtomMappings = scAtomMappings[baseIndex:baseIndex + nAtoms];
-
-    # The positions of atoms from the supercell that are included in the expansion are set to None.
+    expAtomIndices = list(range(baseIndex, baseIndex + nAtoms));
 
-    for i in range(baseIndex, baseIndex + nAtoms):
-        scAtomPositionsCart[i] = None;
+    includedAtoms = np.zeros(len(scAtomPositions), dtype = bool);
+    includedAtoms[baseIndex:baseIndex + nAtoms] = True;
 
     # Next, we cycle through the remaining atoms in the supercell, check the bond distance to atoms included in the expansion and, if the distance is less than the cutoff, include them.
     # This is repeated until no additional atoms are added in the final cycle.
@@ -330,82 +532,90 @@ if __name__ == "__main__":
 
         bondDistances[newKey] = value;
 
-    # For printing status messages.
+    # Atom pairs further apart than the longest bond distance cannot be bonded, so this is used to limit the search.
 
-    cycleNumber = 1;
+    maxBondDistance = max(bondDistances.values(), default = 0.0);
 
-    # To limit the number of warning messages printed.
+    # To avoid looking up bond distances by atom-type pair for every pair of atoms, we assign each atom type an integer index and tabulate the (squared) reference bond distances for every pair of types.
+    # Pairs with no reference distance (including with wildcards) are set to -1.
 
-    pairKeysMissing = [];
+    typeNames = sorted(set(atomTypes));
 
-    while True:
-        addedAtoms = 0;
+    typeIndices = { typeName : i for i, typeName in enumerate(typeNames) };
+
+    atomTypeIndices = np.array([typeIndices[atomType] for atomType in atomTypes], dtype = np.int32);
+
+    bondDistances2 = np.full((len(typeNames), len(typeNames)), -1.0, dtype = np.float64);
+
+    for i, type1 in enumerate(typeNames):
+        for j, type2 in enumerate(typeNames[i:], start = i):
+            bondDistance = _GetBondDistance(type1, type2, bondDistances);
+
+            if bondDistance != None:
+                bondDistances2[i, j] = bondDistances2[j, i] = bondDistance ** 2;
+            else:
+                # If no reference distance is found, print a warning.
 
-        for i, (position1, position1Cart, mapIndex1) in enumerate(zip(scAtomPositions, scAtomPositionsCart, scAtomMappings)):
-            if position1Cart is not None:
-                type1 = atomTypes[mapIndex1];
+                print("  -> WARNING: No reference bond distance for atom pair '{0}', '{1}' (including with wildcards) found in BondDistances.".format(type1, type2));
 
-                # If the supercell position hasn't been set to None, first check whether the atom type appears in the exclude list.
+    scAtomTypeIndices = atomTypeIndices[scAtomMappings];
 
-                if type1 in RestrictExpansionAtoms:
-                    # If so, check the fractional coordinates and decide whether to skip checking whether or not to include it.
+    # Work out which atoms in the supercell should not be included in the expansion due to RestrictExpansionAtoms.
+    # Atoms are excluded if any of the fractional coordinates are outside the range [0, 1] by more than the value set in RestrictExpansionAtoms (coordinates >= 1 are adjusted by -1 for comparison).
+    # Types not in RestrictExpansionAtoms have the limit set to infinity, so they are never excluded.
 
-                    skipAtom = False;
+    restrictLimits = np.full(len(typeNames), np.inf, dtype = np.float64);
 
-                    # If any of the fractional coordinates are outside the range [0, 1], check whether the absolute value is greater than the value set in RestrictExpansionAtoms.
+    for typeName, limit in RestrictExpansionAtoms.items():
+        if typeName in typeIndices:
+            restrictLimits[typeIndices[typeName]] = limit;
 
-                    for f in position1:
-                        if f < 0.0 or f >= 1.0:
-                            # If the fractional coordinate is >= 1, adjust it for comparison.
+    outsideCell = np.logical_or(scAtomPositions < 0.0, scAtomPositions >= 1.0);
 
-                            if f >= 1.0:
-                                f = f - 1.0;
+    outsideDistances = np.where(
+        scAtomPositions < 0.0, -scAtomPositions, scAtomPositions - 1.0
+        );
 
-                            if math.fabs(f) > RestrictExpansionAtoms[type1]:
-                                skipAtom = True;
-                                break;
+    skipAtoms = np.logical_and(
+        outsideCell, outsideDistances > restrictLimits[scAtomTypeIndices][:, np.newaxis]
+        ).any(axis = 1);
 
-                    if skipAtom:
-                        continue;
+    # For printing status messages.
 
-                # Calculate the bond distance to atoms in the include list and compare them to the reference bond distances.
+    cycleNumber = 1;
 
-                for position2Cart, mapIndex2 in zip(expAtomPositions, expAtomMappings):
-                    type2 = atomTypes[mapIndex2];
+    # Atoms that were not bonded to any of the atoms in the include list in one cycle cannot be bonded to them in the next, so in each cycle we only need to compare to the atoms added in the previous cycle (or, in the first cycle, the base unit cell).
+    # newAtomsStart records the position in expAtomIndices of the first of these atoms.
 
-                    # Look up a reference bond distance to compare to.
+    newAtomsStart = 0;
 
-                    pairKey = '-'.join(sorted([type1, type2]));
+    while True:
+        # Find atoms in the supercell that are not (yet) included in the expansion and are close enough to the atoms added to the include list in the previous cycle to be bonded.
 
-                    # First check this pair hasn't already been checked and found missing - if it is, there's no point doing the work to search for it.
+        candidateIndices = np.nonzero(~(includedAtoms | skipAtoms))[0];
 
-                    if pairKey not in pairKeysMissing:
-                        testDistance = None;
+        includedIndices = np.array(expAtomIndices[newAtomsStart:], dtype = np.intp);
 
-                        testKeys = [pairKey] + ['-'.join(sorted(pair)) for pair in [(type1, 'X'), ('X', type2), ('X', 'X')]];
+        newAtomsStart = len(expAtomIndices);
 
-                        for testKey in testKeys:
-                            if testKey in bondDistances:
-                                testDistance = bondDistances[testKey];
+        addIndices = [];
 
-                        # If no reference distance is found, print a warning and add the pair key to the list of missing pair keys.
+        if len(candidateIndices) > 0:
+            bonded = _FindBondedAtoms(
+                scAtomPositionsCart[candidateIndices], scAtomTypeIndices[candidateIndices], scAtomPositionsCart[includedIndices], scAtomTypeIndices[includedIndices], bondDistances2, maxBondDistance
+                );
 
-                        if testDistance == None:
-                            pairKeysMissing.append(pairKey);
+            # Atoms within the reference bond distance of at least one atom in the include list are added to it.
 
-                            print("  -> WARNING: No reference bond distance for atom pair '{0}', '{1}' (including with wildcards) found in BondDistances.".format(type1, type2));
-                        else:
-                            if np.linalg.norm(position1Cart - position2Cart) <= testDistance:
-                                # If the distance is less than or equal to the reference, add the atom to the include list, and set the position in the supercell list to None.
+            addIndices = candidateIndices[bonded].tolist();
 
-                                expAtomPositions.append(position1Cart);
-                                expAtomMappings.append(mapIndex1);
+        # Add the atoms to the include list, in the order they appear in the supercell.
 
-                                scAtomPositionsCart[i] = None;
+        expAtomIndices.extend(addIndices);
 
-                                addedAtoms = addedAtoms + 1;
+        includedAtoms[addIndices] = True;
 
-                                break;
+        addedAtoms = len(addIndices);
 
         print("  -> INFO: Expansion cycle {0} added {1} atom(s)".format(cycleNumber, addedAtoms));
 
@@ -418,6 +628,11 @@ if __name__ == "__main__":
 
     print("");
 
+    # Collect the positions of the atoms in the expanded structure and their mapping to atoms in the original cell.
+
+    expAtomPositions = scAtomPositionsCart[expAtomIndices];
+    expAtomMappings = scAtomMappings[expAtomIndices];
+
     # Build a list of atom types to accompany the expanded structure.
 
     expAtomTypes = [atomTypes[i] for i in expAtomMappings];
@@ -524,10 +739,11 @@ if __name__ == "__main__":
     scaleFactors = None;
 
     if ScaleDisplacements:
-        scaleFactors = [None for i in range(0, len(frequencies))];
+        # The scale factor for each mode is the largest displacement of any atom.
 
-        for i in range(index1, index2):
-            scaleFactors[i] = max(np.linalg.norm(vector) for vector in eigendisplacements[i]);
+        scaleFactors = np.linalg.norm(
+            eigendisplacements[index1:index2], axis = 2
+            ).max(axis = 1);
 
     # The modulation is a cosine oscilaltion between +/- MaxDisplacement.
     # We add a phase factor of 90 degrees (pi/2) so that the oscillation starts at q = 0.
@@ -541,35 +757,28 @@ if __name__ == "__main__":
 
     modulationAmplitudes = modulationAmplitudes * MaxAmplitude;
 
-    modulationPositionSets, modulationAmplitudeSets = [], [];
-
-    # Loop over modes.
+    # Print the modes to be animated.
 
     for modeIndex in range(index1, index2):
         modeFrequency = frequencies[modeIndex];
 
         print("  -> mode = {0: >4}, v = {1: >8.3f} THz ({2: >8.2f} cm^-1)".format(modeIndex + 1, modeFrequency, modeFrequency * _THzToInverseCm));
 
-        eigendisplacement = eigendisplacements[modeIndex];
+    # Set up an (nModes, nSteps) array of amplitudes, scaled if required.
 
-        modulationPositionSet, modulationAmplitudeSet = [], [];
-
-        # Loop over amplitudes.
-
-        for amplitude in modulationAmplitudes:
-            # Scale the amplitude if required.
+    modulationAmplitudeSets = np.tile(
+        modulationAmplitudes, (index2 - index1, 1)
+        );
 
-            if scaleFactors != None:
-                amplitude = amplitude / scaleFactors[modeIndex];
+    if scaleFactors is not None:
+        modulationAmplitudeSets = modulationAmplitudeSets / scaleFactors[:, np.newaxis];
 
-            modulationPositionSet.append(
-                [position + amplitude * eigendisplacement[index] for position, index in zip(expAtomPositions, expAtomMappings)]
-                );
+    # Gather the eigendisplacements of the atoms in the expanded structure for each mode, and generate the modulated positions for all modes and amplitudes as an (nModes, nSteps, nAtoms, 3) array.
+    # The modulated positions are only used for visualisation, so they are generated in single precision (float32) to halve the size of the array; the scale factors and amplitudes are computed, and written to the comment lines, in double precision.
 
-            modulationAmplitudeSet.append(amplitude);
+    modeEigendisplacements = eigendisplacements[index1:index2][:, expAtomMappings, :].astype(np.float32);
 
-        modulationPositionSets.append(modulationPositionSet);
-        modulationAmplitudeSets.append(modulationAmplitudeSet);
+    modulationPositionSets = expAtomPositions.astype(np.float32)[np.newaxis, np.newaxis, :, :] + modulationAmplitudeSets.astype(np.float32)[:, :, np.newaxis, np.newaxis] * modeEigendisplacements[:, np.newaxis, :, :];
 
     print("");
 
@@ -578,13 +787,13 @@ if __name__ == "__main__":
     # ---------
 
     # Write modulation animations to separate XYZ-format files.
-    # Since there may be a lot if these, we store them in a .tar.gz file.
+    # Since there may be a lot if these, we store them in a .tar.zst or .tar.gz file.
 
-    fileName = "{0}_Animations.tar.gz".format(OutputPrefix);
+    fileName = "{0}_Animations.tar.{1}".format(OutputPrefix, "zst" if zstandard != None else "gz");
 
     print("Writing XYZ-format animations to \"{0}\"...".format(fileName));
 
-    with tarfile.open(fileName, 'w:gz') as archiveFile:
+    with _OpenArchiveFile(fileName) as archiveFile:
         for i, (modulationPositionSet, modulationAmplitudeSet) in enumerate(zip(modulationPositionSets, modulationAmplitudeSets)):
             modeIndex = index1 + i;
 
@@ -594,24 +803,26 @@ if __name__ == "__main__":
 
             modeFrequency = frequencies[modeIndex];
 
+            # Write the file to memory and add it to the archive directly, rather than writing it to disk, adding it and deleting it.
+
+            xyzFile = io.StringIO();
+
             _WriteXYZFile(
-                expAtomTypes, modulationPositionSet, xyzFileName,
+                expAtomTypes, modulationPositionSet, xyzFile,
                 commentLines = ["v = {0: >8.3f} THz ({1: >8.2f} cm^-1), q = {2: >8.3f} amu^1/2 A".format(modeFrequency, modeFrequency * _THzToInverseCm, amplitude) for amplitude in modulationAmplitudeSet]
                 );
 
-            archiveFile.add(
-                xyzFileName, arcname = r"Animations/{0}".format(xyzFileName)
-                );
+            xyzData = xyzFile.getvalue().encode('utf-8');
 
-            # There's an issue/odd behaviour (?) on Windows whereby deleting the file immediately after archiving sometimes throws a PermissionError.
-            # This may be due to the script being run in Dropbox and the Dropbox syncing not being able to keep up.
-            # If this happens, catch the first error, sleep for a preset short time delay, then try again.
+            tarInfo = tarfile.TarInfo(name = r"Animations/{0}".format(xyzFileName));
 
-            try:
-                os.remove(xyzFileName);
-            except PermissionError:
-                time.sleep(_DeleteFilePermissionErrorDelay);
-                os.remove(xyzFileName);
+            tarInfo.size = len(xyzData);
+            tarInfo.mtime = time.time();
+            tarInfo.mode = 0o644;
+
+            archiveFile.addfile(
+                tarInfo, io.BytesIO(xyzData)
+                );
 
     print("");
 
@@ -622,20 +833,17 @@ if __name__ == "__main__":
 
     print("Writing merged XYZ-format animations to \"{0}\"...".format(fileName));
 
-    # First, we build lists of merged modulated structures and comment lines.
+    # The merged structures and comment lines are generated on the fly while the file is written, rather than building a second copy of all the frames in memory.
     # The comment lines record the mode index, frequency and normal-mode coordinate for further processing.
 
-    structures, commentLines = [], [];
-
-    for i, (modulationPositionSet, modulationAmplitudeSet) in enumerate(zip(modulationPositionSets, modulationAmplitudeSets)):
-        structures.extend(modulationPositionSet);
-
-        modeIndex = index1 + i;
-        modeFrequency = frequencies[modeIndex];
+    structures = (
+        modulationPositions for modulationPositionSet in modulationPositionSets for modulationPositions in modulationPositionSet
+        );
 
-        commentLines.extend(
-            ["mode = {0: >4}, v = {1: >8.3f} THz ({2: >8.2f} cm^-1), q = {3: >8.3f} amu^1/2 A".format(modeIndex + 1, modeFrequency, modeFrequency * _THzToInverseCm, amplitude) for amplitude in modulationAmplitudeSet]
-            );
+    commentLines = (
+        "mode = {0: >4}, v = {1: >8.3f} THz ({2: >8.2f} cm^-1), q = {3: >8.3f} amu^1/2 A".format(modeIndex + 1, frequencies[modeIndex], frequencies[modeIndex] * _THzToInverseCm, amplitude)
+            for modeIndex, modulationAmplitudeSet in zip(range(index1, index2), modulationAmplitudeSets) for amplitude in modulationAmplitudeSet
+        );
 
     # Write out the data.
 